@@ -1,99 +1,606 @@
 from gpiozero import MCP3008
-import time
-from datetime import datetime
-from openai import OpenAI
+import asyncio
+import atexit
+import signal
+import sys
+from dataclasses import dataclass, fields
+from datetime import datetime, time as dtime, timedelta
+from typing import Protocol
+import openai
+from openai import AsyncOpenAI
 import csv
 import os
-import requests
+import httpx
+import numpy as np
+import pandas as pd
+from tenacity import retry, retry_if_exception, retry_if_exception_type, stop_after_attempt, wait_exponential
 import base64
 import json
 
+# ==== CONFIGURATION ====
+@dataclass
+class Config:
+    machine_name: str = "LabSensor-01"    # Change this for each Pi
+    sms_backend: str = "clicksend"        # "clicksend", "twilio" or "textbelt"
+    sms_to: str = "+1YYYYYYYYYY"          # your phone number for alerts
+    clicksend_username: str = "YOUR_CLICKSEND_USERNAME"
+    clicksend_api_key: str = "YOUR_CLICKSEND_API_KEY"
+    twilio_sid: str = "YOUR_TWILIO_SID"
+    twilio_auth_token: str = "YOUR_TWILIO_AUTH_TOKEN"
+    twilio_from: str = "+1XXXXXXXXXX"     # your Twilio number
+    textbelt_key: str = "YOUR_TEXTBELT_KEY"
+
+    @classmethod
+    def from_env(cls):
+        """Defaults above, overridden by environment variables of the same name in upper case."""
+        overrides = {f.name: os.environ[f.name.upper()] for f in fields(cls) if f.name.upper() in os.environ}
+        return cls(**overrides)
+
+config = Config.from_env()
+
 # ==== MACHINE IDENTIFICATION ====
-MACHINE_NAME = "LabSensor-01"   # Change this for each Pi
+MACHINE_NAME = config.machine_name
+
+# ==== OPENAI SETUP ====
+# tenacity (openai_retry below) is the only retry policy for every OpenAI call,
+# so turn off the SDK's own retries and its 600 s default timeout.
+client = AsyncOpenAI(max_retries=0, timeout=30)
+
+# Per-reading calls only classify one reading, so they get a small, capped model;
+# the frontier model is kept for the once-a-day summary.
+MODEL_SAMPLE = "gpt-4o-mini"
+MODEL_SUMMARY = "gpt-5"
+SAMPLE_PARAMS = {
+    "model": MODEL_SAMPLE,
+    "max_tokens": 120,
+    "temperature": 0.2,
+    "response_format": {"type": "json_object"}
+}
+SAMPLE_JSON_INSTRUCTIONS = (
+    'Reply only with a JSON object of the form {"vapor_event": true|false, "reason": "<one sentence>"}.'
+)
+
+# Back off 1s, 2s, 4s... (capped at 30s) on transient failures before giving up.
+RETRY_STOP = stop_after_attempt(5)
+RETRY_WAIT = wait_exponential(multiplier=1, min=1, max=30)
+
+openai_retry = retry(
+    stop=RETRY_STOP,
+    wait=RETRY_WAIT,
+    retry=retry_if_exception_type((
+        openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError
+    )),
+    reraise=True
+)
+
+@openai_retry
+async def call_openai(**kwargs):
+    """Chat completion with retries on rate limits, dropped connections and 5xx."""
+    return await client.chat.completions.create(**kwargs)
+
+BATCH_POLL_INTERVAL = 60       # seconds between batch status checks
+BATCH_MAX_WAIT = 2 * 60 * 60   # give up on the batch after 2 hours
+
+# ==== SMS SETUP ====
+# One pooled client for the whole run so alerts reuse a warm TCP+TLS connection.
+http = httpx.AsyncClient(
+    timeout=15,
+    limits=httpx.Limits(max_connections=4, max_keepalive_connections=1)
+)
+
+# The Twilio SDK sends through requests, so its dropped connections surface as these.
+try:
+    import requests
+    _REQUESTS_TRANSPORT_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+except ImportError:
+    _REQUESTS_TRANSPORT_ERRORS = ()
+
+def _is_transient_sms_error(e):
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code == 429 or e.response.status_code >= 500
+    if isinstance(e, (httpx.TransportError, *_REQUESTS_TRANSPORT_ERRORS)):
+        return True
+    status = getattr(e, "status", None)   # TwilioRestException carries the HTTP status
+    return isinstance(status, int) and (status == 429 or status >= 500)
+
+sms_retry = retry(stop=RETRY_STOP, wait=RETRY_WAIT, retry=retry_if_exception(_is_transient_sms_error), reraise=True)
+
+class SMSBackend(Protocol):
+    async def send(self, message: str) -> None: ...
+    async def warm_up(self) -> None: ...
+
+class ClickSendBackend:
+    SMS_URL = "https://rest.clicksend.com/v3/sms/send"
+    ACCOUNT_URL = "https://rest.clicksend.com/v3/account"
+
+    def __init__(self, config):
+        auth_str = f"{config.clicksend_username}:{config.clicksend_api_key}"
+        self.headers = {
+            "Authorization": "Basic " + base64.b64encode(auth_str.encode()).decode(),
+            "Content-Type": "application/json"
+        }
+        self.to = config.sms_to
+
+    @sms_retry
+    async def send(self, message):
+        payload = {"messages": [{"source": "python", "body": message, "to": self.to}]}
+        resp = await http.post(self.SMS_URL, headers=self.headers, json=payload)
+        resp.raise_for_status()
+
+    async def warm_up(self):
+        await http.get(self.ACCOUNT_URL, headers=self.headers, timeout=10)
+
+class TwilioBackend:
+    def __init__(self, config):
+        from twilio.rest import Client   # only needed when this backend is selected
+        self.client = Client(config.twilio_sid, config.twilio_auth_token)
+        self.sid = config.twilio_sid
+        self.from_ = config.twilio_from
+        self.to = config.sms_to
+
+    @sms_retry
+    async def send(self, message):
+        # The Twilio SDK is blocking, so keep it off the event loop.
+        await asyncio.to_thread(self.client.messages.create, body=message, from_=self.from_, to=self.to)
+
+    async def warm_up(self):
+        await asyncio.to_thread(self.client.api.accounts(self.sid).fetch)
+
+class TextbeltBackend:
+    SMS_URL = "https://textbelt.com/text"
+    QUOTA_URL = "https://textbelt.com/quota/{key}"
+
+    def __init__(self, config):
+        self.key = config.textbelt_key
+        self.to = config.sms_to
+
+    @sms_retry
+    async def send(self, message):
+        resp = await http.post(self.SMS_URL, data={"phone": self.to, "message": message, "key": self.key})
+        resp.raise_for_status()
+        result = resp.json()
+        if not result.get("success"):
+            raise RuntimeError(f"Textbelt rejected the message: {result.get('error')}")
+
+    async def warm_up(self):
+        await http.get(self.QUOTA_URL.format(key=self.key), timeout=10)
+
+SMS_BACKENDS = {
+    "clicksend": ClickSendBackend,
+    "twilio": TwilioBackend,
+    "textbelt": TextbeltBackend
+}
+sms_backend: SMSBackend = SMS_BACKENDS[config.sms_backend.lower()](config)
+
+async def _do_send_sms(message):
+    """Send an SMS alert through the configured backend."""
+    try:
+        await sms_backend.send(message)
+        print(f"📱 SMS sent: {message}")
+    except Exception as e:
+        print("Error sending SMS:", e)
+
+_sms_q = asyncio.Queue()
 
-# ==== Textbelt Shit ====
-import requests
-resp = requests.post('https://textbelt.com/text', {
-  'phone': '9495690262',
-  'message': "Hello World",
-  'key': 'ee91fbf97e0de9c9186a831226f94054d29fa0ceoAdpnFuaVHMDUZyNepSxhD0zw',
-})
-print(resp.json())
+def send_sms(message):
+    """Queue an SMS for the background sender; never waits on the network."""
+    _sms_q.put_nowait(message)
+
+async def _sms_worker():
+    while True:
+        await _do_send_sms(await _sms_q.get())
 
 # ==== LOGGING SETUP ====
-def get_log_filename():
-    date_str = datetime.now().strftime("%m-%d-%Y")
-    return f"gas_log_{date_str}.csv"
+# Today's file names, recomputed only when the date rolls over.
+_current_date = None
+_current_log_path = None
+_current_summary_path = None
+
+def _refresh_paths(now):
+    global _current_date, _current_log_path, _current_summary_path
+    today = now.date()
+    if today != _current_date:
+        date_str = today.strftime("%m-%d-%Y")
+        _current_date = today
+        _current_log_path = f"gas_log_{date_str}.csv"
+        _current_summary_path = f"summary_{date_str}.txt"
+
+def get_log_filename(now):
+    _refresh_paths(now)
+    return _current_log_path
+
+LOG_HEADER = [
+    "Machine Name", "Timestamp", "Raw Reading (0-1)",
+    "Scaled Reading (0-1023)", "Deviation (%)", "AI Analysis"
+]
+LOG_BUFFER_SIZE = 64 * 1024    # rows sit in memory instead of hitting the SD card each sample
+LOG_FLUSH_ROWS = 10            # fsync after this many rows (alerts are synced right away)
+
+# The day's CSV stays open between samples and is swapped out at midnight.
+_csv_path = None
+_csv_fh = None
+_csv_writer = None
+_pending_rows = 0
+
+def _open_append(filename, exclusive):
+    # O_APPEND makes every write land at the end of the file, even after a crash mid-day.
+    flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND | (os.O_EXCL if exclusive else 0)
+    fd = os.open(filename, flags, 0o644)
+    return os.fdopen(fd, "a", buffering=LOG_BUFFER_SIZE, newline="")
+
+def open_log(now):
+    global _csv_path, _csv_fh, _csv_writer, _pending_rows
+    filename = get_log_filename(now)
+    # O_EXCL creates the file atomically, so only whoever creates it writes the header.
+    try:
+        _csv_fh = _open_append(filename, exclusive=True)
+        _csv_writer = csv.writer(_csv_fh)
+        _csv_writer.writerow(LOG_HEADER)
+    except FileExistsError:
+        _csv_fh = _open_append(filename, exclusive=False)
+        _csv_writer = csv.writer(_csv_fh)
+    _csv_path = filename
+    _pending_rows = 0
+
+def sync_log():
+    global _pending_rows
+    if _csv_fh is None:
+        return
+    _csv_fh.flush()
+    os.fsync(_csv_fh.fileno())
+    _pending_rows = 0
 
-def ensure_log_headers(filename):
-    if not os.path.exists(filename):
-        with open(filename, mode="w", newline="") as file:
-            writer = csv.writer(file)
-            writer.writerow([
-                "Machine Name", "Timestamp", "Raw Reading (0-1)",
-                "Scaled Reading (0-1023)", "Deviation (%)", "AI Analysis"
-            ])
-
-def log_data(machine, timestamp, reading, scaled, deviation, analysis):
-    filename = get_log_filename()
-    ensure_log_headers(filename)
-    with open(filename, mode="a", newline="") as file:
-        writer = csv.writer(file)
-        writer.writerow([machine, timestamp, reading, scaled, deviation, analysis])
-
-def get_summary_filename():
-    date_str = datetime.now().strftime("%m-%d-%Y")
-    return f"summary_{date_str}.txt"
+def close_log():
+    global _csv_path, _csv_fh, _csv_writer
+    if _csv_fh is None:
+        return
+    sync_log()
+    _csv_fh.close()
+    _csv_path = _csv_fh = _csv_writer = None
+
+# Don't lose the buffered tail when the process exits or systemd stops it.
+atexit.register(close_log)
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+def log_data(machine, timestamp, reading, scaled, deviation, analysis, now, alert=False):
+    global _pending_rows
+    if get_log_filename(now) != _csv_path:
+        close_log()
+        open_log(now)
+    _csv_writer.writerow([machine, timestamp, reading, scaled, deviation, analysis])
+    _pending_rows += 1
+    if alert or _pending_rows >= LOG_FLUSH_ROWS:
+        sync_log()
+
+def get_summary_filename(now):
+    _refresh_paths(now)
+    return _current_summary_path
 
 # ==== SENSOR SETUP ====
 gas_sensor = MCP3008(channel=0)
-
-print(f"[{MACHINE_NAME}] Warming up sensor...")
-time.sleep(60)
-print(f"[{MACHINE_NAME}] Warmup complete. Establishing baseline...")
-
-baseline_samples = []
-for _ in range(30):
-    baseline_samples.append(gas_sensor.value)
-    time.sleep(1)
-
-baseline = sum(baseline_samples) / len(baseline_samples)
-print(f"[{MACHINE_NAME}] Baseline established at {baseline:.4f}")
+OVERSAMPLE = 64                # ADC reads averaged per reading (~sqrt(64) = 8x less noise)
+
+def read_oversampled(n=OVERSAMPLE):
+    """Average n back-to-back ADC reads into one lower-noise reading."""
+    return float(np.mean(np.fromiter((gas_sensor.value for _ in range(n)), dtype=np.float32, count=n)))
+
+WARMUP_SECONDS = 60
+BASELINE_SAMPLES = 30
+K_SIGMA = 3.5                  # robust z-score that counts as a significant rise
+ALERT_MIN_DEVIATION = 30       # ...and it must also be at least this far (%) over baseline
+ADC_STEP = 1 / 1023            # one MCP3008 count, the smallest spread we can resolve
+
+baseline = None                # set by establish_baseline()
+baseline_mad = None
+
+# ==== ROLLING WINDOW ====
+WINDOW_SIZE = 288              # one day of 5-minute readings
+CONTEXT_READINGS = 12          # last hour of readings sent to the AI with an alert
+
+# Fixed ring buffer of recent readings: no per-sample allocation once it's full.
+window_buf = np.zeros(WINDOW_SIZE, dtype=np.float32)
+window_idx = 0
+window_filled = 0
+
+def push_reading(reading):
+    global window_idx, window_filled
+    window_buf[window_idx] = reading
+    window_idx = (window_idx + 1) % WINDOW_SIZE
+    window_filled = min(window_filled + 1, WINDOW_SIZE)
+
+def recent_window(n):
+    """The last n readings in the window, oldest first."""
+    n = min(n, window_filled)
+    return window_buf[np.arange(window_idx - n, window_idx) % WINDOW_SIZE]
+
+# ==== WARMUP & BASELINE ====
+async def prime_connections():
+    """Throwaway calls so DNS, TLS and the connection pools are warm before the first real one."""
+    results = await asyncio.gather(
+        client.models.list(),
+        sms_backend.warm_up(),
+        return_exceptions=True
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            print("Connection warmup failed:", result)
+
+async def establish_baseline():
+    global baseline, baseline_mad
+    print(f"[{MACHINE_NAME}] Warming up sensor...")
+    await asyncio.gather(asyncio.sleep(WARMUP_SECONDS), prime_connections())
+    print(f"[{MACHINE_NAME}] Warmup complete. Establishing baseline...")
+
+    baseline_samples = np.empty(BASELINE_SAMPLES, dtype=np.float32)
+    for i in range(BASELINE_SAMPLES):
+        baseline_samples[i] = read_oversampled()
+        await asyncio.sleep(1)
+
+    # Median/MAD instead of mean so a puff during warmup can't skew the baseline.
+    baseline = float(np.median(baseline_samples))
+    baseline_mad = float(np.median(np.abs(baseline_samples - baseline)))
+    for sample in baseline_samples:
+        push_reading(sample)
+    print(f"[{MACHINE_NAME}] Baseline established at {baseline:.4f} (MAD {baseline_mad:.4f})")
+
+def robust_z_score(reading):
+    """Robust z-score of a reading against the rolling window's median and MAD."""
+    window = window_buf[:window_filled]
+    median = float(np.median(window))
+    mad = float(np.median(np.abs(window - median)))
+    # MAD * 1.4826 is comparable to a standard deviation; the ADC-count floor keeps
+    # a perfectly flat window from turning every single count into an alert.
+    return (reading - median) / max(1.4826 * mad, ADC_STEP)
 
 # ==== HELPER FUNCTIONS ====
-def is_weekday():
-    return datetime.now().weekday() < 5
+OPEN_TIME = dtime(7, 0)
+CLOSE_TIME = dtime(16, 0)
+HEARTBEAT_TIME = dtime(7, 5)
+SUMMARY_TIME = dtime(16, 30)
+SAMPLE_INTERVAL = timedelta(seconds=300)
+# Longest single sleep before re-reading the wall clock. A DST change or NTP step can
+# only make a wake-up late by at most this much, at ~48 wakeups a day while idle
+# (vs. the old 600 s / 3600 s polling); the last step before a deadline is exact.
+MAX_SLEEP = 30 * 60
+
+def is_weekday(now):
+    return now.weekday() < 5
+
+def within_operating_hours(now):
+    return OPEN_TIME <= now.time() < CLOSE_TIME
+
+def next_weekday_at(at, after):
+    """First Monday–Friday datetime at wall-clock time `at` that is later than `after`."""
+    when = datetime.combine(after.date(), at)
+    if when <= after:
+        when += timedelta(days=1)
+    while when.weekday() >= 5:
+        when += timedelta(days=1)
+    return when
+
+async def sleep_until(when):
+    """Sleep until wall-clock `when` in steps of at most MAX_SLEEP, re-reading the clock
+    between them so a DST change or NTP correction can't skew a long wait."""
+    while True:
+        remaining = (when - datetime.now()).total_seconds()
+        if remaining <= 0:
+            return
+        await asyncio.sleep(min(remaining, MAX_SLEEP))
+
+def parse_analysis(content):
+    """Turn the model's JSON verdict into the text stored in the AI Analysis column."""
+    if not content:
+        return "pending"   # empty reply; let the batch have another go
+    try:
+        verdict = json.loads(content)
+        reason = str(verdict.get("reason", "")).strip()
+        vapor_event = bool(verdict.get("vapor_event"))
+    except (ValueError, TypeError, AttributeError):
+        return content.strip()
+    if vapor_event:
+        return f"Possible vapor event detected: {reason}"
+    return f"No vapor event: {reason}"
+
+async def explain_reading(timestamp, reading, deviation, z_score, context):
+    """Ask the AI to explain an anomalous reading using the recent readings as context."""
+    sensor_message = (
+        f"Machine: {MACHINE_NAME}\n"
+        f"Time: {timestamp}\n"
+        f"Gas sensor reading (raw): {reading:.4f}\n"
+        f"Deviation from baseline: {deviation:.2f}%\n"
+        f"Robust z-score vs. recent readings: {z_score:.1f}\n"
+        f"Previous readings (oldest first): {', '.join(f'{r:.4f}' for r in context)}"
+    )
+
+    response = await call_openai(
+        **SAMPLE_PARAMS,
+        messages=[
+            {"role": "system", "content": (
+                "You are an air quality monitoring assistant. "
+                "A local rule flagged this reading as a significant rise. "
+                "Using the recent readings, decide whether vapor or gas activity is likely. "
+                + SAMPLE_JSON_INSTRUCTIONS
+            )},
+            {"role": "user", "content": sensor_message}
+        ]
+    )
+    return parse_analysis(response.choices[0].message.content)
+
+# Live alert explanations, keyed by row timestamp, waiting to be written into the CSV
+# by analyze_pending_rows(). Anything lost here (e.g. a restart) goes to the batch.
+alert_explanations = {}
+
+def build_batch_requests(rows):
+    """Build one Batch API request line per row still waiting on AI analysis."""
+    lines = []
+    for i, row in enumerate(rows):
+        if row["AI Analysis"] != "pending":
+            continue
+
+        sensor_message = (
+            f"Machine: {row['Machine Name']}\n"
+            f"Time: {row['Timestamp']}\n"
+            f"Gas sensor reading (scaled): {row['Scaled Reading (0-1023)']}\n"
+            f"Gas sensor reading (raw): {row['Raw Reading (0-1)']}\n"
+            f"Deviation from baseline: {row['Deviation (%)']}%"
+        )
 
-def within_operating_hours():
-    now = datetime.now()
-    return 7 <= now.hour < 16
+        lines.append(json.dumps({
+            "custom_id": f"row-{i}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                **SAMPLE_PARAMS,
+                "messages": [
+                    {"role": "system", "content": (
+                        "You are an air quality monitoring assistant. "
+                        "Analyze this single reading to determine if vapor or gas activity is likely. "
+                        "Only set vapor_event to true if clear evidence exists. "
+                        + SAMPLE_JSON_INSTRUCTIONS
+                    )},
+                    {"role": "user", "content": sensor_message}
+                ]
+            }
+        }))
+    return lines
+
+async def analyze_pending_rows(filename, submit_batch=True):
+    """Backfill the CSV's pending rows from the live alert explanations and, unless
+    submit_batch is False, send whatever is still pending through the Batch API."""
+    with open(filename, "r", newline="") as file:
+        reader = csv.DictReader(file)
+        fieldnames = reader.fieldnames
+        rows = list(reader)
+
+    for row in rows:
+        if row["AI Analysis"] == "pending" and row["Timestamp"] in alert_explanations:
+            row["AI Analysis"] = alert_explanations.pop(row["Timestamp"])
+
+    batch_lines = build_batch_requests(rows) if submit_batch else []
+    if batch_lines:
+        await run_batch(filename, batch_lines, rows)
+
+    # Write the backfilled copy next to the original and swap it in, so a power cut
+    # mid-write leaves either the old log or the new one, never a truncated file.
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, mode="w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_filename, filename)
+
+async def run_batch(filename, batch_lines, rows):
+    """Run the pending rows through the Batch API and fill in their AI Analysis."""
+    try:
+        print(f"📦 Submitting {len(batch_lines)} readings for batch analysis...")
+        batch_file = await openai_retry(client.files.create)(
+            file=(f"batch_{filename}.jsonl", "\n".join(batch_lines).encode()),
+            purpose="batch"
+        )
+        batch = await openai_retry(client.batches.create)(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+
+        waited = 0
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            if waited >= BATCH_MAX_WAIT:
+                # Nothing reads this batch's output after today, so don't keep paying for it.
+                print("Batch analysis still running, cancelling and leaving rows pending.")
+                await openai_retry(client.batches.cancel)(batch.id)
+                return
+            await asyncio.sleep(BATCH_POLL_INTERVAL)
+            waited += BATCH_POLL_INTERVAL
+            batch = await openai_retry(client.batches.retrieve)(batch.id)
+
+        if batch.status != "completed" or not batch.output_file_id:
+            print(f"Batch analysis ended with status '{batch.status}'.")
+            return
+
+        output = (await openai_retry(client.files.content)(batch.output_file_id)).text
+    except Exception as e:
+        print("Error running batch analysis:", e)
+        return
 
-def time_for_summary():
-    now = datetime.now()
-    return now.hour == 16 and 30 <= now.minute < 35
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        try:
+            result = json.loads(line)
+            response = result.get("response") or {}
+            if response.get("status_code") != 200:
+                continue
+            i = int(result["custom_id"].split("-", 1)[1])
+            rows[i]["AI Analysis"] = parse_analysis(response["body"]["choices"][0]["message"]["content"])
+        except (ValueError, TypeError, KeyError, IndexError, AttributeError) as e:
+            print("Skipping malformed batch result:", e)
+
+SUMMARY_EVENT_DEVIATION = 10  # rows above this deviation (%) are quoted verbatim in the summary prompt
+                              # (as are alert rows, i.e. anything not analyzed as "nominal")
+
+def condense_log(filename):
+    """Hourly reading stats plus the notable rows, so the summary prompt stays small."""
+    df = pd.read_csv(filename)
+    hour = pd.to_datetime(df["Timestamp"], format="%m-%d-%Y at %H:%M.%S").dt.hour
+    hourly = df.groupby(hour).agg(
+        low=("Raw Reading (0-1)", "min"),
+        mean=("Raw Reading (0-1)", "mean"),
+        high=("Raw Reading (0-1)", "max"),
+        spread=("Raw Reading (0-1)", "std"),
+        max_dev=("Deviation (%)", "max")
+    ).fillna(0)
+
+    lines = [
+        "| Hour | Min | Mean | Max | Std | Max Deviation (%) |",
+        "|---|---|---|---|---|---|"
+    ]
+    for h, row in hourly.iterrows():
+        lines.append(
+            f"| {h:02d}:00 | {row['low']:.4f} | {row['mean']:.4f} | {row['high']:.4f} "
+            f"| {row['spread']:.4f} | {row['max_dev']:.2f} |"
+        )
 
-def weekday_heartbeat_time():
-    now = datetime.now()
-    return now.weekday() < 5 and now.hour == 7 and 5 <= now.minute < 10
+    notable = (df["Deviation (%)"] > SUMMARY_EVENT_DEVIATION) | (df["AI Analysis"] != "nominal")
+    events = df[notable].drop(columns=["Machine Name"])
+    lines.append("")
+    if events.empty:
+        lines.append(
+            f"No alerts, and no readings deviated more than {SUMMARY_EVENT_DEVIATION}% from baseline."
+        )
+    else:
+        lines.append(f"Alerts and readings more than {SUMMARY_EVENT_DEVIATION}% over baseline:")
+        lines.append(events.to_csv(index=False).strip())
+    return "\n".join(lines)
 
-def summarize_day():
-    filename = get_log_filename()
+async def summarize_day(now):
+    filename = get_log_filename(now)
     if not os.path.exists(filename):
         print("No data to summarize for today.")
         return
 
-    with open(filename, "r") as file:
-        data = file.read()
+    close_log()   # make sure every buffered row is on disk before reading it back
+    try:
+        await analyze_pending_rows(filename, submit_batch=False)
+    except Exception as e:
+        print("Error backfilling AI analysis:", e)
 
     try:
+        data = condense_log(filename)
         print("📊 Generating daily summary...")
-        response = client.chat.completions.create(
-            model="gpt-5",
+        response = await call_openai(
+            model=MODEL_SUMMARY,
+            # gpt-5 is a reasoning model: it takes max_completion_tokens rather than
+            # max_tokens, and minimal effort keeps reasoning from eating the cap.
+            max_completion_tokens=400,
+            reasoning_effort="minimal",
             messages=[
                 {"role": "system", "content": (
                     "You are an air quality monitoring assistant. "
-                    "Summarize the day's gas sensor data concisely, "
-                    "highlighting any unusual spikes or vapor detections."
+                    "Summarize the day's gas sensor data concisely from the hourly statistics "
+                    "and notable readings provided, highlighting any unusual spikes or vapor detections."
                 )},
                 {"role": "user", "content": f"Here is today's data from {MACHINE_NAME}:\n\n{data}"}
             ]
@@ -101,9 +608,9 @@ def summarize_day():
 
         summary = response.choices[0].message.content.strip()
 
-        summary_file = get_summary_filename()
+        summary_file = get_summary_filename(now)
         with open(summary_file, "w") as f:
-            f.write(f"Daily Summary for {MACHINE_NAME} on {datetime.now().strftime('%m-%d-%Y')}\n\n")
+            f.write(f"Daily Summary for {MACHINE_NAME} on {now.strftime('%m-%d-%Y')}\n\n")
             f.write(summary)
 
         print(f"\n=== Daily Summary for {MACHINE_NAME} ===\n{summary}\n")
@@ -112,84 +619,106 @@ def summarize_day():
     except Exception as e:
         print("Error generating or sending summary:", e)
 
+    # Rows whose live explanation failed go through the Batch API only after the
+    # summary is out, so a slow batch can't hold up the 4:30 SMS.
+    try:
+        await analyze_pending_rows(filename)
+    except Exception as e:
+        print("Error backfilling AI analysis:", e)
+
 # ==== MAIN LOOP ====
-print(f"[{MACHINE_NAME}] Active Mon–Fri, 7:00 AM – 4:00 PM, summary at 4:30 PM.")
-summary_sent = False
-heartbeat_sent = False
+# True while readings stay in alert, so a sustained excursion sends one SMS, not one per tick.
+_in_excursion = False
+
+async def tick(now):
+    """Take one reading, log it, and fire any alert without holding up the next sample."""
+    global _in_excursion
+    timestamp = now.strftime("%m-%d-%Y at %H:%M.%S")
+    reading = read_oversampled()
+    scaled_reading = reading * 1023
+    deviation = (reading - baseline) / baseline * 100
+    z_score = robust_z_score(reading)
+    context = recent_window(CONTEXT_READINGS)
+    push_reading(reading)
+
+    print("\n--- New Measurement ---")
+    print(f"Machine: {MACHINE_NAME}")
+    print(f"Time: {timestamp}")
+    print(f"Reading: {reading:.4f} ({deviation:.2f}% from baseline, z={z_score:.1f})")
+
+    # The z-score alone tracks short-term noise (a few ADC counts after oversampling),
+    # so also require a real rise over baseline before spending an SMS and an AI call.
+    is_alert = z_score >= K_SIGMA and deviation > ALERT_MIN_DEVIATION
+
+    # In-band readings never touch the AI; the daily summary still sees them.
+    # Alert rows are written (and synced) right away and explained afterwards.
+    analysis = "pending" if is_alert else "nominal"
+    log_data(MACHINE_NAME, timestamp, f"{reading:.4f}", f"{scaled_reading:.2f}", f"{deviation:.2f}", analysis,
+             now, alert=is_alert)
+
+    was_in_excursion, _in_excursion = _in_excursion, is_alert
+    if is_alert:
+        alert_message = (
+            f"⚠️ ALERT from {MACHINE_NAME} at {timestamp}: "
+            f"Significant increase detected ({deviation:.2f}% over baseline, z={z_score:.1f})!"
+        )
+        print(alert_message)
+
+        if not was_in_excursion:
+            send_sms(alert_message)
 
-while True:
-    now = datetime.now()
+        try:
+            alert_explanations[timestamp] = await explain_reading(timestamp, reading, deviation, z_score, context)
+            print("AI analysis:", alert_explanations[timestamp])
+        except Exception as e:
+            # Left for the end-of-day batch in summarize_day() to fill in.
+            print("Error analyzing with OpenAI:", e)
 
-    # --- Daily weekday heartbeat ---
-    if weekday_heartbeat_time() and not heartbeat_sent:
+async def heartbeat_loop():
+    while True:
+        await sleep_until(next_weekday_at(HEARTBEAT_TIME, datetime.now()))
         send_sms(f"✅ {MACHINE_NAME} Online — monitoring started for the day.")
-        heartbeat_sent = True
-        time.sleep(600)  # avoid duplicates
-        continue
-    elif now.hour == 0:
-        heartbeat_sent = False  # reset flag at midnight
-
-    # --- Only operate Monday–Friday ---
-    if is_weekday():
-        if within_operating_hours():
-            timestamp = now.strftime("%m-%d-%Y at %H:%M.%S")
-            reading = gas_sensor.value
-            scaled_reading = reading * 1023
-            deviation = (reading - baseline) / baseline * 100
-
-            sensor_message = (
-                f"Machine: {MACHINE_NAME}\n"
-                f"Time: {timestamp}\n"
-                f"Gas sensor reading (scaled): {scaled_reading:.2f}\n"
-                f"Gas sensor reading (raw): {reading:.4f}\n"
-                f"Deviation from baseline: {deviation:.2f}%"
-            )
-
-            try:
-                response = client.chat.completions.create(
-                    model="gpt-5",
-                    messages=[
-                        {"role": "system", "content": (
-                            "You are an air quality monitoring assistant. "
-                            "Analyze this single reading to determine if vapor or gas activity is likely. "
-                            "Only report 'possible vapor event detected' if clear evidence exists."
-                        )},
-                        {"role": "user", "content": sensor_message}
-                    ]
-                )
-
-                analysis = response.choices[0].message.content.strip()
-                print("\n--- New Measurement ---")
-                print(f"Machine: {MACHINE_NAME}")
-                print(f"Time: {timestamp}")
-                print("AI analysis:", analysis)
-
-            except Exception as e:
-                print("Error analyzing with OpenAI:", e)
-                analysis = "Error during AI analysis"
-
-            log_data(MACHINE_NAME, timestamp, f"{reading:.4f}", f"{scaled_reading:.2f}", f"{deviation:.2f}", analysis)
-
-            if deviation > 30:
-                alert_message = (
-                    f"⚠️ ALERT from {MACHINE_NAME} at {timestamp}: "
-                    f"Significant increase detected ({deviation:.2f}% over baseline)!"
-                )
-                print(alert_message)
-                send_sms(alert_message)
-
-            time.sleep(300)
-
-        elif time_for_summary() and not summary_sent:
-            summarize_day()
-            summary_sent = True
-            time.sleep(600)
-
-        else:
-            if now.hour == 0 and summary_sent:
-                summary_sent = False
-            time.sleep(600)
 
-    else:
-        print(f"[{MACHINE_NAME}] Weekend mode — sleeping until Monday.")
-        time.sleep(3600)
+async def summary_loop():
+    while True:
+        await sleep_until(next_weekday_at(SUMMARY_TIME, datetime.now()))
+        await summarize_day(datetime.now())
+
+async def sample_loop():
+    running_ticks = set()   # strong refs so in-flight ticks aren't garbage collected
+    next_tick = datetime.now()
+
+    while True:
+        # One clock read per tick, shared by every check below.
+        now = datetime.now()
+
+        # --- Only operate Monday–Friday during operating hours ---
+        if not (is_weekday(now) and within_operating_hours(now)):
+            next_tick = next_weekday_at(OPEN_TIME, now)
+            if not is_weekday(now):
+                print(f"[{MACHINE_NAME}] Weekend mode — sleeping until Monday.")
+            await sleep_until(next_tick)
+            continue   # re-check the day and hours against the clock after waking
+
+        task = asyncio.create_task(tick(now))
+        running_ticks.add(task)
+        task.add_done_callback(running_ticks.discard)
+
+        # Step from the scheduled time, not from when we woke, so samples don't drift.
+        # Capped at one interval from now in case the clock was stepped back.
+        next_tick = min(max(next_tick + SAMPLE_INTERVAL, now), now + SAMPLE_INTERVAL)
+        await sleep_until(next_tick)
+
+async def main():
+    await establish_baseline()
+    print(f"[{MACHINE_NAME}] Active Mon–Fri, 7:00 AM – 4:00 PM, summary at 4:30 PM.")
+    await asyncio.gather(_sms_worker(), heartbeat_loop(), sample_loop(), summary_loop())
+
+# libuv-backed event loop when available; the stock asyncio loop works fine without it.
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
+
+asyncio.run(main())